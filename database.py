@@ -13,6 +13,21 @@ POSTGRES_DB = os.getenv("POSTGRES_DB", "postgres")
 
 DATABASE_URL = f"postgresql://{POSTGRES_USER}:{POSTGRES_PASSWORD}@{DB_HOST}:{DB_PORT}/{POSTGRES_DB}"
 
+# --- Connection Pool Configuration ---
+# Every worker process opens its own pool, so DB_POOL_MAX multiplied by the
+# number of workers must stay below the PostgreSQL server's `max_connections`
+# (100 by default). Unless set explicitly, the per-worker size is derived from
+# a total budget split across WEB_CONCURRENCY workers.
+DB_MAX_CONNECTIONS_TOTAL = int(os.getenv("DB_MAX_CONNECTIONS_TOTAL", "80"))
+WEB_CONCURRENCY = max(int(os.getenv("WEB_CONCURRENCY", "1")), 1)
+DB_POOL_MAX = int(os.getenv("DB_POOL_MAX", str(max(DB_MAX_CONNECTIONS_TOTAL // WEB_CONCURRENCY, 1))))
+DB_POOL_MIN = min(int(os.getenv("DB_POOL_MIN", "2")), DB_POOL_MAX)
+# Prepared statements are per connection; asyncpg keeps an LRU of them on each
+# connection, so repeated identical queries skip the server-side parse/plan.
+DB_STATEMENT_CACHE_SIZE = int(os.getenv("DB_STATEMENT_CACHE_SIZE", "1024"))
+# Seconds to wait for a free pooled connection before giving up.
+DB_ACQUIRE_TIMEOUT = float(os.getenv("DB_ACQUIRE_TIMEOUT", "2.0"))
+
 # This global variable will hold the connection pool.
 pool = None
 
@@ -22,7 +37,14 @@ async def connect_to_db():
     """
     global pool
     try:
-        pool = await asyncpg.create_pool(DATABASE_URL)
+        pool = await asyncpg.create_pool(
+            DATABASE_URL,
+            min_size=DB_POOL_MIN,
+            max_size=DB_POOL_MAX,
+            max_inactive_connection_lifetime=300,
+            command_timeout=30,
+            statement_cache_size=DB_STATEMENT_CACHE_SIZE,
+        )
         print("Database connection pool created successfully.")
     except Exception as e:
         print(f"FATAL: Could not connect to database: {e}")
@@ -1,21 +1,21 @@
 # gemini_service.py
 
 import os
+import random
+import asyncio
 import httpx
+import orjson
+from cachetools import TTLCache
+from typing import Dict, Optional, Tuple
 from fastapi import HTTPException
 
 # --- Gemini API Configuration ---
 API_KEY = os.getenv("GEMINI_API_KEY")
 GEMINI_API_URL = f"https://generativelanguage.googleapis.com/v1beta/models/gemini-2.5-flash-preview-05-20:generateContent?key={API_KEY}"
 
-async def generate_sql_from_gemini(schema_ddl: str, business_logic: str) -> str:
-    """
-    Asynchronously calls the Gemini API to generate a SQL query.
-    """
-    if not API_KEY:
-        raise HTTPException(status_code=500, detail="GEMINI_API_KEY environment variable not set.")
-
-    prompt = f"""
+# --- Prompt Template ---
+# Built once at import time; only the schema and business logic vary per call.
+_PROMPT_TEMPLATE = """
     You are an expert PostgreSQL developer. Your task is to translate a user's business logic into a precise and executable PostgreSQL query based on the provided database schema.
 
     **Instructions:**
@@ -34,18 +34,148 @@ async def generate_sql_from_gemini(schema_ddl: str, business_logic: str) -> str:
 
     **Generated PostgreSQL Query:**
     """
+
+# --- Retry Configuration ---
+MAX_ATTEMPTS = 3
+MAX_RETRY_DELAY = 30.0  # seconds
+# Only errors raised before Gemini could have received the request are retried;
+# read/write timeouts fail fast instead of re-sending a request that may be in progress.
+RETRYABLE_ERRORS = (httpx.ConnectError, httpx.ConnectTimeout, httpx.RemoteProtocolError)
+
+# --- Generated SQL Cache ---
+# Identical business logic against the same schema yields the same query, so
+# results are cached by (schema SHA-256, business logic).
+SQL_CACHE_SIZE = 512
+SQL_CACHE_TTL = 3600  # seconds
+_sql_cache: TTLCache = TTLCache(maxsize=SQL_CACHE_SIZE, ttl=SQL_CACHE_TTL)
+# One task per in-flight key, so concurrent duplicate prompts share one upstream
+# call and all of them see its result (or failure) at the same time.
+_sql_inflight: Dict[Tuple[str, str], asyncio.Task] = {}
+
+# This global variable will hold the shared HTTP client, so that connections
+# (and TLS sessions) to the Gemini API are reused across requests.
+_client: Optional[httpx.AsyncClient] = None
+
+async def init_http_client() -> httpx.AsyncClient:
+    """
+    Initializes the shared HTTP client used for Gemini API calls.
+    """
+    global _client
+    if _client is None:
+        _client = httpx.AsyncClient(
+            http2=True,
+            timeout=60.0,
+            limits=httpx.Limits(max_keepalive_connections=20, max_connections=100),
+        )
+        print("Gemini HTTP client created successfully.")
+    return _client
+
+async def close_http_client():
+    """
+    Closes the shared HTTP client.
+    """
+    global _client
+    if _client is not None:
+        await _client.aclose()
+        _client = None
+        print("Gemini HTTP client closed.")
+
+def _retry_delay(response: Optional[httpx.Response], attempt: int) -> float:
+    """
+    Returns how long to wait before the next attempt, honoring a `Retry-After` header if present.
+    """
+    if response is not None:
+        retry_after = response.headers.get("Retry-After")
+        if retry_after:
+            try:
+                return min(max(float(retry_after), 0.0), MAX_RETRY_DELAY)
+            except ValueError:
+                pass
+    return 2 ** attempt + random.random() * 0.25
+
+async def _post_with_retry(client: httpx.AsyncClient, payload: dict) -> httpx.Response:
+    """
+    Posts to the Gemini API, retrying with exponential backoff on 429, 5xx and connection failures.
+    """
+    content = orjson.dumps(payload)
+    for attempt in range(MAX_ATTEMPTS):
+        is_last_attempt = attempt == MAX_ATTEMPTS - 1
+        try:
+            response = await client.post(GEMINI_API_URL, content=content, headers={"content-type": "application/json"})
+        except RETRYABLE_ERRORS:
+            if is_last_attempt:
+                raise
+            await asyncio.sleep(_retry_delay(None, attempt))
+            continue
+        if (response.status_code < 500 and response.status_code != 429) or is_last_attempt:
+            return response
+        await asyncio.sleep(_retry_delay(response, attempt))
+
+async def generate_sql_from_gemini(schema_ddl: str, business_logic: str, client: httpx.AsyncClient) -> str:
+    """
+    Asynchronously calls the Gemini API to generate a SQL query using the given client.
+    """
+    if not API_KEY:
+        raise HTTPException(status_code=500, detail="GEMINI_API_KEY environment variable not set.")
+
+    prompt = _PROMPT_TEMPLATE.format(schema_ddl=schema_ddl, business_logic=business_logic)
     payload = {"contents": [{"role": "user", "parts": [{"text": prompt}]}]}
-    async with httpx.AsyncClient(timeout=60.0) as client:
+    try:
+        response = await _post_with_retry(client, payload)
+        response.raise_for_status()
+        result = orjson.loads(response.content)
         try:
-            response = await client.post(GEMINI_API_URL, json=payload)
-            response.raise_for_status()
-            result = response.json()
-            if (result.get("candidates") and result["candidates"][0].get("content") and result["candidates"][0]["content"].get("parts") and result["candidates"][0]["content"]["parts"][0].get("text")):
-                generated_text = result["candidates"][0]["content"]["parts"][0]["text"]
-                return generated_text.strip().replace("```sql", "").replace("```", "").strip()
-            else:
-                raise HTTPException(status_code=500, detail="Could not parse the response from the AI model.")
-        except httpx.RequestError as e:
-            raise HTTPException(status_code=503, detail=f"Service Unavailable: Could not connect to the AI model: {e}")
-        except Exception as e:
-            raise HTTPException(status_code=500, detail=f"An unexpected error occurred: {e}")
+            generated_text = result["candidates"][0]["content"]["parts"][0]["text"]
+        except (KeyError, IndexError, TypeError):
+            generated_text = None
+        if not generated_text:
+            raise HTTPException(status_code=500, detail="Could not parse the response from the AI model.")
+        # Strip the markdown code fence the model sometimes wraps the query in.
+        return generated_text.strip().removeprefix("```sql").removeprefix("```").removesuffix("```").strip()
+    except HTTPException:
+        raise
+    except httpx.RequestError as e:
+        raise HTTPException(status_code=503, detail=f"Service Unavailable: Could not connect to the AI model: {e}")
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"An unexpected error occurred: {e}")
+
+async def _generate_and_cache(key: Tuple[str, str], schema_ddl: str, business_logic: str, client: httpx.AsyncClient) -> str:
+    """
+    Calls Gemini and stores the generated query in the cache.
+    """
+    generated_query = await generate_sql_from_gemini(schema_ddl=schema_ddl, business_logic=business_logic, client=client)
+    _sql_cache[key] = generated_query
+    return generated_query
+
+def _discard_inflight(key: Tuple[str, str], task: asyncio.Task):
+    """
+    Removes a finished task from the in-flight map, marking its exception as retrieved.
+    """
+    if _sql_inflight.get(key) is task:
+        del _sql_inflight[key]
+    if not task.cancelled():
+        task.exception()
+
+async def generate_sql_cached(schema_ddl: str, schema_hash: str, business_logic: str, client: httpx.AsyncClient) -> str:
+    """
+    Returns the SQL query for the business logic, calling Gemini only on a cache miss.
+    Concurrent requests for the same key wait on a single Gemini call.
+    """
+    key = (schema_hash, business_logic)
+    cached = _sql_cache.get(key)
+    if cached is not None:
+        return cached
+
+    task = _sql_inflight.get(key)
+    if task is None:
+        task = asyncio.ensure_future(_generate_and_cache(key, schema_ddl, business_logic, client))
+        _sql_inflight[key] = task
+        task.add_done_callback(lambda t: _discard_inflight(key, t))
+    # Shield the shared call so one client disconnecting does not cancel it for the others.
+    return await asyncio.shield(task)
+
+def invalidate_cached_sql(schema_hash: str, business_logic: str):
+    """
+    Drops a cached query, e.g. after it failed to execute, so the next request asks Gemini again.
+    """
+    _sql_cache.pop((schema_hash, business_logic), None)
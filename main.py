@@ -2,18 +2,42 @@
 
 from fastapi import FastAPI, HTTPException, UploadFile, File
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.middleware.gzip import GZipMiddleware
+from fastapi.responses import Response
 from pydantic import BaseModel
 import os
+import asyncio
+import codecs
+import contextlib
+import hashlib
+import re
+import tempfile
+import time
+import aiofiles
 import asyncpg
+import orjson
 from typing import List, Dict, Any
 
 # Import functions from the new service and database files
-from database import connect_to_db, close_db_connection, get_db_pool
-from gemini_service import generate_sql_from_gemini
+from database import connect_to_db, close_db_connection, get_db_pool, DB_ACQUIRE_TIMEOUT
+from gemini_service import generate_sql_cached, invalidate_cached_sql, init_http_client, close_http_client
 
 # --- Constants ---
 UPLOAD_DIR = "uploads"
 SCHEMA_FILE_PATH = os.path.join(UPLOAD_DIR, "schema.sql")
+UPLOAD_CHUNK_SIZE = 1 << 20  # 1 MiB
+# Upper bound on the number of rows returned from an executed query.
+MAX_ROWS = int(os.getenv("MAX_ROWS", "10000"))
+# Only plain SELECT / read-only WITH queries can be wrapped in a subquery and
+# serialized by PostgreSQL; anything else (DML, SHOW, EXPLAIN, SELECT INTO) runs as-is.
+_READ_ONLY_QUERY_RE = re.compile(r"^\s*\(*\s*(SELECT|WITH)\b", re.IGNORECASE)
+_DATA_MODIFYING_RE = re.compile(r"\b(INSERT|UPDATE|DELETE|MERGE|INTO)\b", re.IGNORECASE)
+# How often (in seconds) the schema file is checked for changes made by other workers.
+SCHEMA_RECHECK_INTERVAL = float(os.getenv("SCHEMA_RECHECK_INTERVAL", "5.0"))
+
+# In-memory copy of the uploaded schema, keyed on the file's modification time.
+# The SHA-256 digest lets re-uploads of an identical file keep the cached copy.
+_schema_cache: Dict[str, Any] = {"mtime": 0, "ddl": None, "sha256": None, "checked_at": 0.0}
 
 
 # --- Pydantic Models for Request and Response ---
@@ -35,9 +59,12 @@ class GenerateAndExecuteResponse(BaseModel):
     """
     Defines the structure of the combined response, returning both the
     generated SQL query and the data fetched from the database.
+    `truncated` is set when the query returned more than MAX_ROWS rows; `data`
+    then holds the first MAX_ROWS rows in the query's own order.
     """
     sql_query: str
     data: List[Dict[str, Any]]
+    truncated: bool = False
 
 class UploadResponse(BaseModel):
     """
@@ -47,11 +74,31 @@ class UploadResponse(BaseModel):
     filename: str
 
 
+# --- Application Lifespan ---
+@contextlib.asynccontextmanager
+async def lifespan(app: FastAPI):
+    """
+    On startup, create the uploads directory, load any previously uploaded schema,
+    and initialize the database connection pool and the shared HTTP client used
+    for Gemini API calls. On shutdown, close both.
+    """
+    os.makedirs(UPLOAD_DIR, exist_ok=True)
+    await load_schema()
+    await connect_to_db()
+    app.state.http_client = await init_http_client()
+    try:
+        yield
+    finally:
+        await close_http_client()
+        await close_db_connection()
+
+
 # --- FastAPI Application Initialization ---
 app = FastAPI(
     title="SQL Generator API",
     description="An API that uses Gemini to translate business logic into a SQL query, and then executes it.",
     version="1.4.0", # Version bump for refactoring
+    lifespan=lifespan,
 )
 
 # --- CORS Middleware Configuration ---
@@ -59,25 +106,51 @@ app.add_middleware(
     CORSMiddleware,
     allow_origins=["http://localhost:3000"],
     allow_credentials=True,
-    allow_methods=["GET", "POST", "OPTIONS"],
-    allow_headers=["*"],
+    allow_methods=["GET", "POST"],
+    allow_headers=["content-type", "authorization"],
+    max_age=86400,  # Let browsers cache preflight responses for 24 hours
 )
 
-# --- Application Lifecycle Events ---
-@app.on_event("startup")
-async def startup_event():
+# --- Response Compression ---
+# Compress larger responses (e.g. big result sets from /generate-and-execute/).
+app.add_middleware(GZipMiddleware, minimum_size=1024)
+
+# --- Helper Functions ---
+async def load_schema(force: bool = False):
     """
-    On startup, create the uploads directory and initialize the database connection pool.
+    Loads the schema file into the in-memory cache if it changed on disk (or if forced).
     """
-    os.makedirs(UPLOAD_DIR, exist_ok=True)
-    await connect_to_db()
+    _schema_cache["checked_at"] = time.monotonic()
+    if not os.path.exists(SCHEMA_FILE_PATH):
+        _schema_cache.update(mtime=0, ddl=None, sha256=None)
+        return
+    try:
+        mtime = os.path.getmtime(SCHEMA_FILE_PATH)
+        if force or _schema_cache["ddl"] is None or _schema_cache["mtime"] != mtime:
+            # Hash the raw bytes, exactly like the upload handler does, so both digests match.
+            async with aiofiles.open(SCHEMA_FILE_PATH, "rb") as f:
+                raw = await f.read()
+            _schema_cache.update(mtime=mtime, ddl=raw.decode("utf-8"), sha256=hashlib.sha256(raw).hexdigest())
+    except (OSError, UnicodeDecodeError) as e:
+        print(f"WARNING: Could not load schema file {SCHEMA_FILE_PATH}: {e}")
+        _schema_cache.update(mtime=0, ddl=None, sha256=None)
+
+def is_read_only_query(sql: str) -> bool:
+    """
+    Returns True if the query is a plain SELECT or WITH query without data-modifying statements.
+    """
+    return bool(_READ_ONLY_QUERY_RE.match(sql)) and not _DATA_MODIFYING_RE.search(sql)
 
-@app.on_event("shutdown")
-async def shutdown_event():
+async def get_schema() -> str:
     """
-    On shutdown, close the database connection pool.
+    Returns the uploaded DDL schema from memory. The file is only checked for
+    changes (e.g. uploads handled by another worker) every SCHEMA_RECHECK_INTERVAL seconds.
     """
-    await close_db_connection()
+    if time.monotonic() - _schema_cache["checked_at"] >= SCHEMA_RECHECK_INTERVAL:
+        await load_schema()
+    if _schema_cache["ddl"] is None:
+        raise HTTPException(status_code=400, detail="No schema file found. Please use the /upload-schema/ endpoint first.")
+    return _schema_cache["ddl"]
 
 
 # --- API Endpoints ---
@@ -87,14 +160,43 @@ async def upload_ddl_schema(file: UploadFile = File(..., description="The dump.s
     """
     Uploads a `dump.sql` file. The schema is stored for subsequent calls.
     """
+    tmp_path = None
     try:
-        contents = await file.read()
-        with open(SCHEMA_FILE_PATH, "wb") as f:
-            f.write(contents)
+        # Each upload gets its own temporary file, so concurrent uploads never share one.
+        fd, tmp_path = tempfile.mkstemp(dir=UPLOAD_DIR, suffix=".sql.tmp")
+        os.close(fd)
+        os.chmod(tmp_path, 0o644)  # mkstemp creates the file as 0600
+        # Stream the upload to the temporary file in chunks so memory use does not grow
+        # with the file size, and only replace the current schema once it decodes as UTF-8.
+        digest = hashlib.sha256()
+        decoder = codecs.getincrementaldecoder("utf-8")()
+        try:
+            async with aiofiles.open(tmp_path, "wb") as out:
+                while chunk := await file.read(UPLOAD_CHUNK_SIZE):
+                    decoder.decode(chunk)
+                    digest.update(chunk)
+                    await out.write(chunk)
+            decoder.decode(b"", final=True)
+        except UnicodeDecodeError:
+            raise HTTPException(status_code=400, detail="The schema file must be UTF-8 encoded.")
+        os.replace(tmp_path, SCHEMA_FILE_PATH)
+        sha256 = digest.hexdigest()
+        if _schema_cache["ddl"] is not None and _schema_cache["sha256"] == sha256:
+            # Same schema as before: keep the cached copy, only track the new mtime.
+            _schema_cache["mtime"] = os.path.getmtime(SCHEMA_FILE_PATH)
+        else:
+            # New schema: load it into the cache now, so requests never wait on disk I/O.
+            await load_schema(force=True)
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"There was an error uploading the file: {e}")
     finally:
         await file.close()
+        # Only left behind if the upload failed before replacing the schema file.
+        if tmp_path is not None:
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(tmp_path)
     return UploadResponse(message=f"Successfully uploaded and saved schema from {file.filename}", filename=file.filename)
 
 
@@ -103,17 +205,20 @@ async def generate_and_execute_endpoint(request: SQLRequest):
     """
     Generates a SQL query from business logic, executes it, and returns both.
     """
-    # Step 1: Read the schema from the uploaded file
-    if not os.path.exists(SCHEMA_FILE_PATH):
-        raise HTTPException(status_code=400, detail="No schema file found. Please use the /upload-schema/ endpoint first.")
-    with open(SCHEMA_FILE_PATH, "r") as f:
-        schema_ddl = f.read()
+    # Step 1: Read the schema from the uploaded file (served from memory when unchanged)
+    schema_ddl = await get_schema()
     
     if not request.business_logic:
         raise HTTPException(status_code=400, detail="Business logic must not be empty.")
 
-    # Step 2: Call Gemini to generate the SQL query
-    generated_query = await generate_sql_from_gemini(schema_ddl=schema_ddl, business_logic=request.business_logic)
+    # Step 2: Call Gemini to generate the SQL query (reused if this prompt was seen before)
+    schema_hash = _schema_cache["sha256"]
+    generated_query = await generate_sql_cached(
+        schema_ddl=schema_ddl,
+        schema_hash=schema_hash,
+        business_logic=request.business_logic,
+        client=app.state.http_client,
+    )
 
     print(generated_query)
 
@@ -122,21 +227,61 @@ async def generate_and_execute_endpoint(request: SQLRequest):
     if not pool:
         raise HTTPException(status_code=503, detail="Database connection is not available.")
     
-    data = []
-    async with pool.acquire() as connection:
-        try:
-            records = await connection.fetch(generated_query)
-            # Convert the list of Record objects to a list of dictionaries for JSON serialization
-            data = [dict(record) for record in records]
-        except asyncpg.PostgresError as e:
-            # If a SQL error occurs, return a 400 error but include the faulty SQL
-            # in the response detail to help the user debug it.
-            raise HTTPException(
-                status_code=400, 
-                detail={"sql_query": generated_query, "error": f"SQL Error: {e}"}
-            )
-        except Exception as e:
-            raise HTTPException(status_code=500, detail=f"An unexpected error occurred during execution: {e}")
+    # For read-only queries, let PostgreSQL serialize the rows into a single JSON
+    # array instead of converting each Record to a dict and re-encoding it in
+    # Python. At most MAX_ROWS + 1 rows are read, the extra one only to detect
+    # truncation. Rows keep the order produced by the generated query's ORDER BY.
+    # The newline before the closing paren keeps a trailing
+    # `-- comment` in the generated query from swallowing it, and `_q.*` always
+    # refers to the whole row, even if the query returns a column named `_q`.
+    read_only = is_read_only_query(generated_query)
+    wrapped_query = (
+        f"SELECT COALESCE(json_agg(t._row ORDER BY t._n) FILTER (WHERE t._n <= {MAX_ROWS}), '[]'::json), count(*) > {MAX_ROWS} "
+        f"FROM (SELECT to_json(_q.*) AS _row, row_number() OVER () AS _n FROM ({generated_query.rstrip().rstrip(';')}\n) _q LIMIT {MAX_ROWS + 1}) t"
+    )
+    try:
+        # Bound the wait for a free connection so bursts get backpressure instead of queueing forever.
+        async with pool.acquire(timeout=DB_ACQUIRE_TIMEOUT) as connection:
+            try:
+                # fetchrow()/cursor() go through the connection's prepared statement cache,
+                # so re-running an identical query skips the parse/plan step.
+                if read_only:
+                    data, truncated = await connection.fetchrow(wrapped_query)
+                else:
+                    # Read through a server-side cursor so at most MAX_ROWS + 1
+                    # rows are ever held in memory.
+                    async with connection.transaction():
+                        cursor = await connection.cursor(generated_query)
+                        records = await cursor.fetch(MAX_ROWS + 1)
+            except asyncpg.PostgresError as e:
+                # Don't keep serving a query that fails; a retry should ask Gemini again.
+                invalidate_cached_sql(schema_hash, request.business_logic)
+                # If a SQL error occurs, return a 400 error but include the faulty SQL
+                # in the response detail to help the user debug it.
+                raise HTTPException(
+                    status_code=400, 
+                    detail={"sql_query": generated_query, "error": f"SQL Error: {e}"}
+                )
+            except Exception as e:
+                raise HTTPException(status_code=500, detail=f"An unexpected error occurred during execution: {e}")
+    except (asyncio.TimeoutError, asyncpg.TooManyConnectionsError):
+        # No free pooled connection in time, or the server refused a new one.
+        raise HTTPException(
+            status_code=503,
+            detail="Database is busy, please retry shortly.",
+            headers={"Retry-After": "1"},
+        )
 
     # Step 4: Return the combined response
-    return GenerateAndExecuteResponse(sql_query=generated_query, data=data)
\ No newline at end of file
+    if not read_only:
+        # Convert the list of Record objects to a list of dictionaries for JSON serialization
+        data = [dict(record) for record in records[:MAX_ROWS]]
+        return GenerateAndExecuteResponse(sql_query=generated_query, data=data, truncated=len(records) > MAX_ROWS)
+
+    # Splice in the JSON built by the database (same shape as GenerateAndExecuteResponse).
+    content = (
+        b'{"sql_query":' + orjson.dumps(generated_query)
+        + b',"data":' + data.encode()
+        + b',"truncated":' + orjson.dumps(truncated) + b"}"
+    )
+    return Response(content=content, media_type="application/json")
\ No newline at end of file